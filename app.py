@@ -1,9 +1,10 @@
-import os, streamlit as st
+import os, re, atexit, streamlit as st
 from datetime import date
-from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from youtube_transcript_api import YouTubeTranscriptApi, TranscriptsDisabled, NoTranscriptFound
 from supabase import create_client, Client, AuthApiError
-import openai, httpx
+import openai, httpx, orjson, diskcache
 
 # ╭────────── Load secrets ───────────╮
 try:
@@ -21,38 +22,153 @@ missing = [n for n, v in {
 if missing:
     raise RuntimeError(f"Missing secrets: {', '.join(missing)}")
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-oa = openai.OpenAI(api_key=OPENAI_KEY)
+# ── Clients (cached across reruns) ──
+# Pooled client for raw calls that pass their own headers (orjson bulk inserts)
+@st.cache_resource
+def get_http() -> httpx.Client:
+    client = httpx.Client(
+        limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100),
+        timeout=5,
+    )
+    atexit.register(client.close)
+    return client
+
+def new_supabase() -> Client:
+    # Fresh, uncached client per login – signing in rewrites a client's Authorization header
+    return create_client(SUPABASE_URL, SUPABASE_KEY)
+
+@st.cache_resource
+def get_supabase() -> Client:
+    # Supabase keeps its own HTTP client: its sub-clients write base_url/auth headers onto it
+    return create_client(SUPABASE_URL, SUPABASE_KEY)
+
+@st.cache_resource
+def get_openai() -> openai.OpenAI:
+    http = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100),
+        timeout=30,
+    )
+    atexit.register(http.close)
+    return openai.OpenAI(api_key=OPENAI_KEY, http_client=http)
+
+@st.cache_resource
+def get_ytcache() -> diskcache.Cache:
+    cache = diskcache.Cache(".ytcache")
+    atexit.register(cache.close)
+    return cache
+
+_http = get_http()
+_ytcache = get_ytcache()
+supabase: Client = get_supabase()
+oa = get_openai()
 
 # ── Helper fns ──────────────────────
+# youtube.com/watch?…v=ID or youtu.be/ID, with exactly 11 id characters
+_YT_RE = re.compile(
+    r"^https?://(?:(?:www\.)?youtube\.com/watch\?(?:[^#]*&)?v=|youtu\.be/)([\w-]{11})(?![\w-])"
+)
+
+# Only saves work for duplicate links within one paste (Streamlit reruns rebuild the cache)
+@lru_cache(maxsize=4096)
 def youtube_id(url: str) -> str | None:
-    q = urlparse(url)
-    if q.hostname == "youtu.be": return q.path[1:]
-    if q.hostname in ("www.youtube.com", "youtube.com") and q.path == "/watch":
-        return parse_qs(q.query).get("v", [None])[0]
-    return None
+    m = _YT_RE.search(url)
+    return m.group(1) if m else None
+
+YT_CACHE_TTL = 7 * 24 * 3600
 
 def yt_transcript(vid: str):
-    try: return YouTubeTranscriptApi.get_transcript(vid)
+    # Disk cache first, then YouTube; only successful fetches are persisted
+    tr = _ytcache.get(vid)
+    if tr is not None: return tr
+    try: tr = YouTubeTranscriptApi.get_transcript(vid)
     except (TranscriptsDisabled, NoTranscriptFound): return None
+    _ytcache.set(vid, tr, expire=YT_CACHE_TTL)
+    return tr
 
-def save_transcript(vid: str, tr: list[dict]):
-    supabase_postgrest.table("youtube_transcripts").insert(
+def rest_insert(table: str, rows: list[dict], token: str):
+    # Bulk insert straight to PostgREST with orjson – much faster than stdlib json for large payloads
+    _http.post(
+        f"{SUPABASE_URL}/rest/v1/{table}",
+        content=orjson.dumps(rows),
+        headers={
+            "apikey": SUPABASE_KEY,
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json",
+            "Prefer": "return=minimal",
+        },
+        timeout=30,
+    ).raise_for_status()
+
+def save_transcripts(items: list[tuple[str, list[dict]]], token: str):
+    rows = [
         dict(
             video_id=vid,
             title=f"Video {vid}",
             transcript_text="\n".join(c["text"] for c in tr),
-            transcript_json=tr,
         )
-    ).execute()
+        for vid, tr in items
+    ]
+    if rows:
+        rest_insert("youtube_transcripts", rows, token)
+
+# ── Retrieval ───────────────────────
+EMBED_MODEL = "text-embedding-3-small"
+CHUNK_CHARS = 2000  # ≈ 500 tokens
+TOP_K = 6
+EMBED_BATCH = 256  # stay well under the embeddings API per-request input limits
+
+def chunk_transcript(tr: list[dict]) -> list[str]:
+    chunks, cur, size = [], [], 0
+    for c in tr:
+        cur.append(c["text"]); size += len(c["text"]) + 1
+        if size >= CHUNK_CHARS:
+            chunks.append("\n".join(cur)); cur, size = [], 0
+    if cur: chunks.append("\n".join(cur))
+    return chunks
 
+def embed(texts: list[str]) -> list[list[float]]:
+    return [
+        d.embedding
+        for i in range(0, len(texts), EMBED_BATCH)
+        for d in oa.embeddings.create(model=EMBED_MODEL, input=texts[i:i + EMBED_BATCH]).data
+    ]
+
+def save_chunks(items: list[tuple[str, list[dict]]], token: str):
+    keyed = [(vid, i, text) for vid, tr in items for i, text in enumerate(chunk_transcript(tr))]
+    if not keyed: return
+    vectors = embed([text for _, _, text in keyed])
+    rest_insert("transcript_chunks", [
+        dict(video_id=vid, chunk_index=i, content=text, embedding=vec)
+        for (vid, i, text), vec in zip(keyed, vectors)
+    ], token)
+
+def relevant_chunks(vid: str, question: str) -> list[str]:
+    hits = supabase_postgrest.rpc(
+        "match_transcript_chunks",
+        {"vid": vid, "query_embedding": embed([question])[0], "match_count": TOP_K},
+    ).execute().data
+    # Keep transcript order so the excerpts read naturally
+    return [h["content"] for h in sorted(hits, key=lambda h: h["chunk_index"])]
+
+@st.cache_data(ttl=30, show_spinner=False)
 def profile(uid: str):
     return supabase_postgrest.table("user_profile").select("*").eq("id", uid).single().execute().data
 
-def bump_counter(uid: str):
-    supabase_postgrest.table("user_profile").update(
-        dict(daily_chat_count=1, last_chat_date=str(date.today()))
-    ).eq("id", uid).execute()
+def bump_counter() -> int | None:
+    # Single atomic increment of the caller's row in Postgres (see sql/increment_chat.sql);
+    # returns today's count, or None if the user has no profile row
+    count = supabase_postgrest.rpc("increment_chat", {}).execute().data
+    profile.clear()
+    return count
+
+@st.cache_data(ttl=600, show_spinner=False)
+def list_videos():
+    return supabase_postgrest.table("youtube_transcripts").select("video_id", "title").order("title").execute().data
+
+def transcript_text(vid: str) -> str:
+    # Full text is only needed when retrieval finds nothing, so fetch it for one video on demand
+    return supabase_postgrest.table("youtube_transcripts").select("transcript_text").eq("video_id", vid).single().execute().data["transcript_text"]
 
 # ── Auth UI ─────────────────────────
 if "user" not in st.session_state:
@@ -66,11 +182,12 @@ if "user" not in st.session_state:
                 st.error("Email & password required")
             else:
                 try:
-                    result = supabase.auth.sign_in_with_password(
+                    client = new_supabase()
+                    result = client.auth.sign_in_with_password(
                         {"email": email, "password": pw}
                     )
                     st.session_state.user = result.user
-                    st.session_state.session = result.session
+                    st.session_state.sb = client
                     st.success("✅ Login successful! Reloading app...")
                     st.rerun()
 
@@ -92,11 +209,12 @@ if "user" not in st.session_state:
                 st.error("Email & password required")
             else:
                 try:
-                    result = supabase.auth.sign_up(
+                    auth_client = new_supabase()
+                    result = auth_client.auth.sign_up(
                         {"email": email_s, "password": pw_s, "options": {"data": {"full_name": fullname}}}
                     )
                     user_id = result.user.id
-                    supabase.table("user_profile").insert({
+                    auth_client.table("user_profile").insert({
                         "id": user_id,
                         "full_name": fullname,
                         "approved": False,
@@ -112,11 +230,14 @@ if "user" not in st.session_state:
     st.stop()
 
 # ── User token for postgrest ─────────
-session = supabase.auth.get_session()
-if session and session.access_token:
-    supabase_postgrest = supabase.with_auth(session.access_token)
-else:
-    supabase_postgrest = supabase
+# The client that signed in holds this user's session and refreshes the JWT;
+# the cached `supabase` client is only for anonymous access
+supabase_postgrest: Client = st.session_state.sb
+session = supabase_postgrest.auth.get_session()
+if not session:
+    del st.session_state.user, st.session_state.sb
+    st.rerun()
+access_token = session.access_token
 
 # ── Approval gate ───────────────────
 user = st.session_state.user
@@ -132,18 +253,50 @@ mode = st.sidebar.radio("Mode", ("Downloader", "Chatbot"))
 
 if mode == "Downloader":
     st.header("📥 Download transcripts")
-    links_text = st.text_area("YouTube links (one per line)", key="link_input")
-    if st.button("Fetch", key="fetch_btn"):
-        for link in [l.strip() for l in links_text.splitlines() if l.strip()]:
-            vid = youtube_id(link)
-            if not vid:
-                st.error(f"{link} → invalid"); continue
-            tr = yt_transcript(vid)
-            if tr:
-                save_transcript(vid, tr)
-                st.success(f"{link} → saved")
-            else:
-                st.warning(f"{link} → no transcript")
+    with st.form("fetch"):
+        links_text = st.text_area("YouTube links (one per line)", key="link_input")
+        fetch = st.form_submit_button("Fetch")
+    if fetch:
+        links = [l.strip() for l in links_text.splitlines() if l.strip()]
+        vids = [(link, youtube_id(link)) for link in links]
+        for link, vid in vids:
+            if not vid: st.error(f"{link} → invalid")
+
+        # Skip videos that are already stored (one lookup for the whole batch)
+        wanted = list({vid for _, vid in vids if vid})
+        existing = {
+            r["video_id"] for r in
+            supabase_postgrest.table("youtube_transcripts").select("video_id").in_("video_id", wanted).execute().data
+        } if wanted else set()
+        pending, seen = [], set()
+        for link, vid in vids:
+            if not vid: continue
+            if vid in existing: st.info(f"{link} → already stored")
+            elif vid not in seen: pending.append((link, vid)); seen.add(vid)
+
+        # Transcript fetches are independent network calls – run them concurrently
+        results = []
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = {executor.submit(yt_transcript, vid): (link, vid) for link, vid in pending}
+            for fut in as_completed(futures):
+                link, vid = futures[fut]
+                try: tr = fut.result()
+                except Exception as e:
+                    st.warning(f"{link} → {e}"); continue
+                if tr:
+                    results.append((vid, tr))
+                    st.success(f"{link} → fetched")
+                else:
+                    st.warning(f"{link} → no transcript")
+
+        # One bulk insert instead of a request per video
+        if results:
+            save_transcripts(results, access_token)
+            list_videos.clear()
+            st.success(f"{len(results)} transcript(s) saved")
+            # Indexing is best-effort: unindexed videos are answered from the full transcript
+            try: save_chunks(results, access_token)
+            except Exception as e: st.warning(f"Transcripts saved but not indexed for search: {e}")
 
 else:
     if not prof["can_chat"]:
@@ -152,32 +305,48 @@ else:
     if prof["last_chat_date"] == str(date.today()) and prof["daily_chat_count"] >= 2:
         st.warning("Daily quota (2 questions) reached."); st.stop()
 
-    rows = supabase_postgrest.table("youtube_transcripts").select("video_id", "title").execute().data
+    rows = list_videos()
     if not rows:
         st.info("No transcripts stored yet."); st.stop()
 
-    label = st.selectbox(
+    # Options are video ids so the selection survives the cached list being refreshed
+    titles = {r["video_id"]: r["title"] for r in rows}
+    vid = st.selectbox(
         "Choose a video",
-        [f"{r['title']} ({r['video_id']})" for r in rows],
+        list(titles),
+        format_func=lambda v: f"{titles[v]} ({v})",
         key="video_select",
     )
-    vid = label.split("(")[-1][:-1]
 
-    question = st.text_input("Ask your question", key="question_input")
-    if question:
-        tx = supabase_postgrest.table("youtube_transcripts").select("transcript_text").eq("video_id", vid).single().execute().data["transcript_text"]
-        prompt = f"Answer only from this transcript:\n{tx}\n\nQ: {question}\nA:"
+    with st.form("ask"):
+        question = st.text_input("Ask your question", key="question_input")
+        submitted = st.form_submit_button("Ask")
+    if submitted and question:
+        # Reserve the quota slot up front so concurrent chats can't both slip under the cap
+        count = bump_counter()
+        if count is None:
+            st.error("Could not update your chat quota."); st.stop()
+        if count > 2:
+            st.warning("Daily quota (2 questions) reached."); st.stop()
+        st.chat_message("user").write(question)
         try:
-            res = oa.chat.completions.create(
+            # Only send the most relevant excerpts; fall back to the full text for unindexed videos
+            try: tx = "\n...\n".join(relevant_chunks(vid, question))
+            except Exception as e:
+                st.toast(f"Transcript search failed, using the full transcript: {e}"); tx = ""
+            tx = tx or transcript_text(vid)
+            stream = oa.chat.completions.create(
                 model="gpt-3.5-turbo",
                 messages=[
-                    {"role": "system", "content": "Use only the transcript."},
-                    {"role": "user", "content": prompt},
+                    # Context goes in the system message and the user turn is just the question
+                    {"role": "system", "content": f"Use only this transcript:\n{tx}"},
+                    {"role": "user", "content": question},
                 ],
+                stream=True,
             )
-            ans = res.choices[0].message.content
-            st.chat_message("user").write(question)
-            st.chat_message("assistant").write(ans)
-            bump_counter(user.id)
+            def tokens():
+                for chunk in stream:
+                    if chunk.choices: yield chunk.choices[0].delta.content or ""
+            st.chat_message("assistant").write_stream(tokens())
         except Exception as e:
             st.error(e)
@@ -0,0 +1,26 @@
+-- Atomically bump the calling user's daily chat counter and return the new value.
+-- Resets to 1 on the first chat of a new day.
+--
+-- Runs as the function owner and only ever touches the row of auth.uid(), so clients
+-- don't need (and shouldn't have) UPDATE rights on the quota columns of user_profile.
+drop function if exists release_chat(uuid);
+drop function if exists increment_chat(uuid);
+
+create or replace function increment_chat()
+returns integer
+language sql
+security definer
+set search_path = public
+as $$
+    update user_profile
+       set daily_chat_count = case
+               when last_chat_date = current_date then daily_chat_count + 1
+               else 1
+           end,
+           last_chat_date = current_date
+     where id = auth.uid()
+ returning daily_chat_count;
+$$;
+
+revoke execute on function increment_chat() from public, anon;
+grant execute on function increment_chat() to authenticated;
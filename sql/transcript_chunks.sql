@@ -0,0 +1,37 @@
+-- Embedded ~500-token transcript chunks for retrieval (requires pgvector).
+create extension if not exists vector;
+
+create table if not exists transcript_chunks (
+    id          bigserial primary key,
+    video_id    text    not null,
+    chunk_index integer not null,
+    content     text    not null,
+    embedding   vector(1536) not null
+);
+
+-- One row per chunk; also serves lookups by video_id
+drop index if exists transcript_chunks_video_id_idx;
+create unique index if not exists transcript_chunks_video_chunk_key on transcript_chunks (video_id, chunk_index);
+
+-- Same access as youtube_transcripts: signed-in users can read and add, anon gets nothing
+alter table transcript_chunks enable row level security;
+
+drop policy if exists "Authenticated users can read chunks" on transcript_chunks;
+create policy "Authenticated users can read chunks"
+    on transcript_chunks for select to authenticated using (true);
+
+drop policy if exists "Authenticated users can add chunks" on transcript_chunks;
+create policy "Authenticated users can add chunks"
+    on transcript_chunks for insert to authenticated with check (true);
+
+-- Top-k chunks of one video closest to the question embedding.
+create or replace function match_transcript_chunks(vid text, query_embedding vector(1536), match_count int)
+returns table (chunk_index integer, content text)
+language sql stable
+as $$
+    select chunk_index, content
+      from transcript_chunks
+     where video_id = vid
+     order by embedding <-> query_embedding
+     limit match_count;
+$$;